@@ -5,12 +5,47 @@ Python script to collect the output of the SHOW VPN-SESSIONDB ANYCONNECT command
 set of Cisco ASA firewalls. The output is then saved to a Microsoft Excel file.
 """
 
+import atexit
+import os
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from getpass import getpass
+from operator import itemgetter
+import ntc_templates
 from netmiko import ConnectHandler
-from openpyxl import Workbook, load_workbook
+from netmiko.exceptions import (
+    NetmikoAuthenticationException,
+    NetmikoTimeoutException,
+    ReadTimeout,
+)
+from openpyxl import Workbook
 from openpyxl.utils.cell import get_column_letter
-from openpyxl.worksheet.table import Table
+from openpyxl.worksheet.table import Table, TableColumn
+from textfsm import TextFSM
+
+# Open Netmiko connections keyed by (host, port, username) so they can be reused
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+# Compiling the network.toCode() template once instead of on every command.
+# TextFSM objects keep state between parses, so access is serialised by a lock.
+_TEMPLATE_DIR = os.environ.get(
+    "NET_TEXTFSM", os.path.join(os.path.dirname(ntc_templates.__file__), "templates")
+)
+_TEMPLATE = os.path.join(
+    _TEMPLATE_DIR, "cisco_asa_show_vpn-sessiondb_anyconnect.textfsm"
+)
+with open(_TEMPLATE) as template:
+    _TFSM = TextFSM(template)
+_TFSM_LOCK = threading.Lock()
+# Lowercase template values, used as the dictionary keys and column headings
+_HEADINGS = tuple(heading.lower() for heading in _TFSM.header)
+
+# Number of connection attempts made when a firewall times out
+_CONNECT_ATTEMPTS = 3
 
 
 def main():
@@ -19,9 +54,12 @@ def main():
      - Contains the inventory of Cisco ASA firewalls to be queried.
      - Obtains the current date and time.
      - Calls a function to retrieve credentials for the firewalls.
-     - Iterates through the inventory, calling a function to retieve the desired
-       information.
-     - Calls a function to save the information to a Microsoft Excel file.
+     - Queries the inventory concurrently, calling a function to retieve the desired
+       information. Firewalls that reject the credentials are retried one at a time
+       with new credentials.
+     - Calls a function to save the information to a Microsoft Excel file. Firewalls
+       that did not respond are marked in the spreadsheet and the script exits with an
+       error; nothing is saved when no firewall responded.
     """
 
     username, password = get_creds()
@@ -43,14 +81,45 @@ def main():
     now = datetime.now()
     tab_name = now.strftime("%Y_%m_%d_%H_%M_%S")
 
+    firewalls = [primary, secondary]
+    sessions = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(firewalls)) as executor:
+        futures = {
+            executor.submit(show_vpn_sessiondb, firewall): firewall
+            for firewall in firewalls
+        }
+        for future in as_completed(futures):
+            firewall = futures[future]
+            try:
+                sessions[firewall["host"]] = future.result()
+            except NetmikoAuthenticationException:
+                failed.append(firewall)
+            except (NetmikoTimeoutException, ReadTimeout):
+                print(f"ERROR: No response from {firewall['host']}")
+
+    # Retrying serially so only one thread ever prompts for credentials
+    for firewall in failed:
+        try:
+            sessions[firewall["host"]] = retry_show_vpn_sessiondb(firewall)
+        except (NetmikoTimeoutException, ReadTimeout):
+            print(f"ERROR: No response from {firewall['host']}")
+
+    # Firewalls that did not respond are recorded as None so they can be
+    # told apart from firewalls without any sessions
     results = []
-    for firewall in [primary, secondary]:
-        results.append(firewall["host"])
-        vpn_sessiondb = show_vpn_sessiondb(firewall)
-        results.append(vpn_sessiondb)
+    for firewall in firewalls:
+        results.append((firewall["host"], sessions.get(firewall["host"])))
+
+    no_response = [host for host, rows in results if rows is None]
+    if len(no_response) == len(results):
+        exit("ERROR: No firewalls responded, nothing was saved")
 
     output_to_excel(tab_name, results)
 
+    if no_response:
+        exit(f"ERROR: Incomplete results, no response from {', '.join(no_response)}")
+
 
 def get_creds():
     """
@@ -78,94 +147,179 @@ def show_vpn_sessiondb(device):
     collect the output from the SHOW VPN-SESSIONDB ANYCONNECT command. It uses TextFSM
     from network.toCode() to convert the output from one large string to structured data.
 
+    Timeouts are retried with exponential backoff, while authentication failures are
+    raised so the caller can ask for new credentials.
+
+    ARGS:
+        device (Dictionary): Device information used by Netmiko.
+    """
+
+    for attempt in range(_CONNECT_ATTEMPTS):
+        try:
+            net_connect = get_connection(device)
+            break
+        except NetmikoTimeoutException:
+            if attempt == _CONNECT_ATTEMPTS - 1:
+                raise
+            time.sleep(2**attempt)
+    print(f"Gathering information from {device['host']}")
+    output = net_connect.send_command("show vpn-sessiondb anyconnect")
+    return parse_vpn_sessiondb(output)
+
+
+def parse_vpn_sessiondb(output):
+    """
+    The parse_vpn_sessiondb() function converts the raw SHOW VPN-SESSIONDB ANYCONNECT
+    output to a list of dictionaries using the cached TextFSM template. The keys are
+    the lowercase template values, matching what Netmiko returns with use_textfsm.
+
+    ARGS:
+        output (String): The command output from the firewall.
+    """
+
+    with _TFSM_LOCK:
+        _TFSM.Reset()
+        parsed = _TFSM.ParseText(output)
+    return [dict(zip(_HEADINGS, row)) for row in parsed]
+
+
+def get_connection(device):
+    """
+    The get_connection() function returns an open Netmiko connection to the firewall,
+    reusing one from the pool when it is still alive. Connections are closed when the
+    script exits.
+
     ARGS:
         device (Dictionary): Device information used by Netmiko.
     """
 
-    done = False
-    while not done:
+    key = (device["host"], device.get("port", 22), device["username"])
+    with _POOL_LOCK:
+        net_connect = _POOL.get(key)
+    if net_connect is not None:
+        if net_connect.is_alive():
+            return net_connect
+        # Closing the stale connection so its transport is not leaked
+        try:
+            net_connect.disconnect()
+        except Exception:
+            pass
+
+    # Connecting outside the lock so other firewalls are not held up
+    net_connect = ConnectHandler(**device)
+    with _POOL_LOCK:
+        _POOL[key] = net_connect
+    return net_connect
+
+
+def _close_all():
+    """
+    The _close_all() function disconnects every connection left in the pool.
+    """
+
+    with _POOL_LOCK:
+        connections = list(_POOL.values())
+        _POOL.clear()
+    for net_connect in connections:
         try:
-            net_connect = ConnectHandler(**device)
-            print(f"Gathering information from {device['host']}")
-            done = True
-        except:
-            print("\n")
-            print(f"ERROR: Invalid username or password for {device['host']}")
-            username, password = get_creds()
-            device["username"] = username
-            device["password"] = password
+            net_connect.disconnect()
+        except Exception:
+            pass
+
+
+def retry_show_vpn_sessiondb(device):
+    """
+    The retry_show_vpn_sessiondb() function queries the user for new credentials and
+    calls show_vpn_sessiondb() until the firewall accepts them.
+
+    ARGS:
+        device (Dictionary): Device information used by Netmiko.
+    """
 
-    output = net_connect.send_command("show vpn-sessiondb anyconnect", use_textfsm=True)
-    net_connect.disconnect()
-    return output
+    while True:
+        print("\n")
+        print(f"ERROR: Invalid username or password for {device['host']}")
+        username, password = get_creds()
+        device["username"] = username
+        device["password"] = password
+        try:
+            return show_vpn_sessiondb(device)
+        except NetmikoAuthenticationException:
+            pass
 
 
 def output_to_excel(tab, data):
     """
-    The output_to_excel() function saves information to a Microsoft Excel file.
+    The output_to_excel() function saves information to a new Microsoft Excel file for
+    each run, so earlier results never have to be loaded back into memory.
 
     ARGS:
-        tab (String): Current date and time used to create the tab name and the table
-        name in the spreadsheet.
+        tab (String): Current date and time used to create the file name, the tab name
+        and the table name in the spreadsheet.
 
-        data (List): The data saved to a spreadsheet.
+        data (List): The data saved to a spreadsheet, as (hostname, rows) tuples where
+        rows is the list of dictionaries returned by show_vpn_sessiondb(), or None when
+        the firewall did not respond.
     """
 
     PATH = r"S:\Cit\Operations\Network\AnyConnect"
-    FILE = r"\AnyConnect.xlsx"
+    FILE = rf"\AnyConnect_{tab}.xlsx"
     excel_file = PATH + FILE
 
-    try:
-        wb = load_workbook(filename=excel_file)
-    except:
-        wb = Workbook()
-        ws = wb.active
-        wb.remove(ws)
-
-    ws = wb.create_sheet(tab, 0)
-
-    ws.cell(1, 1, "Firewall")
-    column_number = {}
-    # Using the first dictionary from the second item
-    # in the list to generate the column headings
-    headings = data[1][0].keys()
-    number_of_columns = len(headings) + 1
-    max_column = get_column_letter(number_of_columns)
-    for element, heading in enumerate(headings, 2):
-        # Populating the column header cells
-        ws.cell(1, element, heading)
-        # Creating a dictionary to store the column headers
-        # with their column number because dictionaries are unordered
-        column_number[heading] = element
+    # Using the TextFSM template values as the column headings so a firewall
+    # without any sessions does not matter
+    header = ("Firewall",) + _HEADINGS
+    max_column = get_column_letter(len(header))
 
-    row_number = 1
-    # Iterating through the list
-    for item in data:
-        if type(item) == str:
-            hostname = item
-        else:
-            # Iterating through the list of dictionaries
-            for row_data in item:
-                row_number += 1
-                # Populating the first cell in the row with the firewall name
-                ws.cell(row_number, 1, hostname)
-                for column_heading in headings:
-                    # Populating the rest of the cells in the row by using
-                    # a dictionary lookup where the column header is the key
-                    ws.cell(
-                        row_number,
-                        column_number.get(column_heading),
-                        row_data.get(column_heading),
-                    )
-
-    table_ref = f"A1:{max_column}{row_number}"
-    table_name = f"_{tab}"
-    vpn_table = Table(displayName=table_name, ref=table_ref)
-    ws.add_table(vpn_table)
+    # Pulling every value out of a row in heading order with one call
+    get_values = itemgetter(*_HEADINGS)
+
+    # Streaming the rows to disk without holding every cell in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(tab)
+
+    # Write-only sheets need the panes frozen before the first row is written
     ws.freeze_panes = "D2"
+    # Binding the method once instead of looking it up for every row
+    append = ws.append
+    append(header)
+    row_number = 1
+    for hostname, item in data:
+        if item is None:
+            # Marking the firewall so a missing response is visible in the report
+            row_number += 1
+            append((hostname, "ERROR: NO RESPONSE"))
+            continue
+        for row_data in item:
+            row_number += 1
+            # The firewall name fills the first cell, followed by the row values
+            append((hostname,) + get_values(row_data))
+
+    # Excel repairs away a table without any data rows, so one is only
+    # added when there is at least one row below the header
+    if row_number > 1:
+        table_ref = f"A1:{max_column}{row_number}"
+        table_name = f"_{tab}"
+        vpn_table = Table(displayName=table_name, ref=table_ref)
+        # Naming the table columns explicitly because write-only sheets
+        # cannot be read back to find the header cells
+        vpn_table.tableColumns = [
+            TableColumn(id=column, name=heading)
+            for column, heading in enumerate(header, 1)
+        ]
+        with warnings.catch_warnings():
+            # openpyxl warns in write-only mode even when the columns are already set
+            warnings.filterwarnings(
+                "ignore", message="In write-only mode", category=UserWarning
+            )
+            ws.add_table(vpn_table)
     wb.save(excel_file)
     print(f"Recorded {row_number} rows in spreadsheet {excel_file}")
 
 
+# Disconnecting any pooled connections when the script exits
+atexit.register(_close_all)
+
+
 if __name__ == "__main__":
     main()